@@ -21,11 +21,15 @@ from __future__ import annotations
 
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 # ------------------ Config ------------------
 RAW_BASE_REL = Path("data/raw")
@@ -35,13 +39,32 @@ PROCESSED_REL = Path("data/processed")
 UK_LAT_BOUNDS = (49.8, 60.9)
 UK_LON_BOUNDS = (-8.7, 1.8)
 ALLOWED_SPEEDS = {5, 10, 15, 20, 30, 40, 50, 60, 70, 80}
+ALLOWED_SPEED_LUT = np.zeros(max(ALLOWED_SPEEDS) + 1, dtype=bool)  # index by mph -> allowed?
+ALLOWED_SPEED_LUT[sorted(ALLOWED_SPEEDS)] = True
 SENTINELS = {-1, 97, 98, 99, 997, 998, 999}
+SENTINEL_ARR = np.array(sorted(SENTINELS), dtype=np.int64)
+
+# Parquet writer settings (ZSTD; larger row groups read faster downstream; v2 pages for delta encodings)
+PARQUET_WRITE_OPTS = dict(
+    compression="zstd", compression_level=3,
+    row_group_size=500_000, write_statistics=True, data_page_version="2.0",
+)
+# Wide-range integers that pack better as deltas; every other column is dictionary-encoded
+DELTA_COLS = {"collision_year", "age_of_driver", "age_of_vehicle", "age_of_casualty", "engine_capacity_cc"}
 
 # Keys and expected files
 COLLISION_KEY = "collision_index"
 VEH_KEYS = [COLLISION_KEY, "vehicle_reference"]
 CAS_KEYS = [COLLISION_KEY, "vehicle_reference", "casualty_reference"]
 
+# Parse-time types for columns where inference is wrong or unstable across blocks:
+# keys/refs stay strings (keeps leading zeros), coords stay float even in an all-NA block
+CSV_TYPES = {
+    COLLISION_KEY: pa.string(), "collision_ref_no": pa.string(),
+    "vehicle_reference": pa.string(), "casualty_reference": pa.string(),
+    "latitude": pa.float64(), "longitude": pa.float64(),
+}
+
 EXPECTED = {
     "collisions": ["Collisions.csv"],
     "vehicles":   ["Vehicles.csv"],
@@ -56,6 +79,13 @@ COLLISION_CONTEXT = [
     "light_conditions", "weather_conditions", "urban_or_rural_area",
 ]
 
+# Small-range codes/counts in that context; int16 is plenty (Arrow casts are overflow-checked)
+SMALL_INT_COLS = [
+    "collision_year", "police_force", "collision_severity",
+    "number_of_vehicles", "number_of_casualties", "speed_limit",
+    "light_conditions", "weather_conditions", "urban_or_rural_area",
+]
+
 # ------------------ Utils ------------------
 def repo_root(start: Path | None = None) -> Path:
     cur = start or Path.cwd()
@@ -80,9 +110,12 @@ def find_dataset_root(raw_base: Path) -> Path | None:
                 return d
     return None
 
-def find_file(root: Path, names: List[str]) -> Path | None:
+def list_csvs(root: Path) -> List[Path]:
+    """Walk the tree once and collect every .csv (any case)."""
+    return [p for p in root.rglob("*") if p.suffix.lower() == ".csv"]
+
+def find_file(all_csvs: List[Path], names: List[str]) -> Path | None:
     """Exact match first, then substring (e.g., Vehicles_2024.csv)."""
-    all_csvs = list(root.rglob("*.csv")) + list(root.rglob("*.CSV"))
     for nm in names:
         for p in all_csvs:
             if p.name.lower() == nm.lower():
@@ -95,25 +128,108 @@ def find_file(root: Path, names: List[str]) -> Path | None:
     return None
 
 def read_csv_any(path: Path) -> pd.DataFrame:
-    """Use Arrow if available; fallback to default engine."""
+    """Parse with Arrow into Arrow-backed dtypes; only retry with the C engine if Arrow rejects the file."""
+    # pyarrow.csv directly: pandas' pyarrow engine applies dtype= only after inference, so
+    # e.g. collision_ref_no would lose its leading zeros before becoming a string
     try:
-        return pd.read_csv(path, engine="pyarrow")
-    except Exception:
-        return pd.read_csv(path)
+        tbl = pacsv.read_csv(path, convert_options=pacsv.ConvertOptions(column_types=CSV_TYPES))
+        return tbl.to_pandas(types_mapper=pd.ArrowDtype)
+    except pa.ArrowInvalid:
+        logging.warning(f"Arrow could not parse {path.name}; retrying with the C engine")
+        dtype = {c: pd.ArrowDtype(t) for c, t in CSV_TYPES.items()}
+        return pd.read_csv(path, engine="c", dtype_backend="pyarrow", dtype=dtype)
+
+def share_key_categories(frames: List[pd.DataFrame], key: str) -> None:
+    """Convert `key` to one CategoricalDtype shared by all frames, so merges/groupbys hash int codes."""
+    frames = [df for df in frames if key in df.columns]
+    if not frames:  # key is optional, as in the original per-column guard
+        return
+    cats = pd.unique(pd.concat([df[key] for df in frames], ignore_index=True).dropna())
+    cat_dtype = pd.CategoricalDtype(categories=cats)
+    for df in frames:
+        df[key] = df[key].astype(cat_dtype)
+
+def drop_duplicate_keys(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    """Keep the first row per key combo, deduping on one 64-bit row hash instead of a multi-column group index.
+
+    Categorical keys are hashed via their int codes, so category strings aren't re-hashed per table.
+    """
+    cols = {k: df[k].cat.codes if isinstance(df[k].dtype, pd.CategoricalDtype) else df[k] for k in keys}
+    h = pd.util.hash_pandas_object(pd.DataFrame(cols), index=False).to_numpy()
+    _, first = np.unique(h, return_index=True)
+    return df.iloc[np.sort(first)].reset_index(drop=True)
 
 def coerce_sentinels_to_na(df: pd.DataFrame) -> pd.DataFrame:
-    """Turn DfT sentinel codes into proper NA for integer-like columns."""
+    """Turn DfT sentinel codes into proper NA for integer-like columns.
+
+    Each integer column is masked with one vectorized isin and written back as
+    nullable integers (Arrow-backed if the column was), so NA doesn't force a
+    float upcast.
+    """
     for c in df.columns:
-        if pd.api.types.is_integer_dtype(df[c]):
-            df[c] = df[c].replace(list(SENTINELS), pd.NA)
+        if not pd.api.types.is_integer_dtype(df[c]):
+            continue
+        # per column: the 2-D DataFrame.to_numpy(na_value=...) path can hand back a read-only view
+        vals = df[c].to_numpy(dtype=np.int64, na_value=0)
+        mask = np.isin(vals, SENTINEL_ARR) | df[c].isna().to_numpy()
+        if isinstance(df[c].dtype, pd.ArrowDtype):
+            df[c] = pd.arrays.ArrowExtensionArray(pa.array(vals, mask=mask))
+        else:
+            df[c] = pd.arrays.IntegerArray(vals, mask)
     return df
 
-def within_uk_mask(lat: pd.Series, lon: pd.Series) -> pd.Series:
-    """Keep rows inside the UK bounding box; do not drop rows with NA coords."""
-    ok_lat = lat.between(UK_LAT_BOUNDS[0], UK_LAT_BOUNDS[1], inclusive="both")
-    ok_lon = lon.between(UK_LON_BOUNDS[0], UK_LON_BOUNDS[1], inclusive="both")
-    out_of_box = (~lat.isna()) & (~lon.isna()) & (~(ok_lat & ok_lon))
-    return ~out_of_box  # True = keep
+def write_parquet(tbl: pa.Table, path: Path) -> None:
+    """Write with PARQUET_WRITE_OPTS: integer DELTA_COLS (incl. _x/_y merge copies) delta-packed, the rest dictionary."""
+    # Shared categorical keys are a join/dedupe device only: publish them as plain values,
+    # not dictionary columns carrying every key from all three inputs
+    tbl = tbl.cast(pa.schema(
+        [pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f for f in tbl.schema],
+        metadata=tbl.schema.metadata,
+    ))
+    delta = [
+        f.name for f in tbl.schema
+        if pa.types.is_integer(f.type) and f.name.removesuffix("_x").removesuffix("_y") in DELTA_COLS
+    ]
+    pq.write_table(
+        tbl, path,
+        use_dictionary=[c for c in tbl.column_names if c not in delta],
+        column_encoding=dict.fromkeys(delta, "DELTA_BINARY_PACKED"),
+        **PARQUET_WRITE_OPTS,
+    )
+
+def within_uk_mask(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Keep rows inside the UK bounding box; do not drop rows with NA coords (NaN in the float arrays)."""
+    return np.isnan(lat) | np.isnan(lon) | (
+        (lat >= UK_LAT_BOUNDS[0]) & (lat <= UK_LAT_BOUNDS[1])
+        & (lon >= UK_LON_BOUNDS[0]) & (lon <= UK_LON_BOUNDS[1])
+    )  # True = keep
+
+def allowed_speed_mask(speed: np.ndarray) -> np.ndarray:
+    """True where speed (float mph, NaN = NA) is a whole number in ALLOWED_SPEEDS; one gather from the lookup table."""
+    in_lut = (speed >= 0) & (speed < len(ALLOWED_SPEED_LUT))  # False for NaN
+    mph = np.where(in_lut, speed, 0).astype(np.int64)
+    return in_lut & (mph == speed) & ALLOWED_SPEED_LUT[mph]
+
+def count_parity_mismatches(acc: pd.DataFrame, child: pd.DataFrame, count_col: str, ref_col: str) -> int:
+    """Collisions whose stated child count != distinct child refs present (+ keys seen only in the child table).
+
+    Counts distinct non-NA (collision, ref) pairs per shared categorical code with a bincount, so no
+    Index is built on collisions. Pairs are deduped here because the child's own dedupe key can be
+    wider (casualty refs repeat across vehicle_reference). An NA stated count always counts as a
+    mismatch, as in the original sub(..., fill_value=0) != 0 (NaN != 0 is True).
+    """
+    pairs = child.loc[child[ref_col].notna(), [COLLISION_KEY, ref_col]]
+    pairs = drop_duplicate_keys(pairs, [COLLISION_KEY, ref_col])
+    acc_codes = acc[COLLISION_KEY].cat.codes.to_numpy() + 1  # slot 0 = NA key
+    n_child = np.bincount(
+        pairs[COLLISION_KEY].cat.codes.to_numpy() + 1,
+        minlength=len(acc[COLLISION_KEY].cat.categories) + 1,
+    )
+    stated = acc[count_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    on_acc = np.count_nonzero(np.isnan(stated) | (stated != n_child[acc_codes]))
+    in_acc = np.zeros(len(n_child), dtype=bool)
+    in_acc[acc_codes] = True
+    return int(on_acc + np.count_nonzero((n_child > 0) & ~in_acc))
 
 # ------------------ Pipeline ------------------
 def main():
@@ -133,18 +249,22 @@ def main():
             f"or set UK_RS_DATA_DIR to the directory."
         )
 
-    acc_path = find_file(DATA_ROOT, EXPECTED["collisions"])
-    veh_path = find_file(DATA_ROOT, EXPECTED["vehicles"])
-    cas_path = find_file(DATA_ROOT, EXPECTED["casualties"])
+    all_csvs = list_csvs(DATA_ROOT)
+    acc_path = find_file(all_csvs, EXPECTED["collisions"])
+    veh_path = find_file(all_csvs, EXPECTED["vehicles"])
+    cas_path = find_file(all_csvs, EXPECTED["casualties"])
     missing = [nm for nm, p in [("Collisions.csv", acc_path), ("Vehicles.csv", veh_path), ("Casualties.csv", cas_path)] if p is None]
     if missing:
         raise FileNotFoundError(f"Missing expected files: {', '.join(missing)}")
 
     logging.info(f"Loading\n- {acc_path}\n- {veh_path}\n- {cas_path}")
 
-    acc = read_csv_any(acc_path)
-    veh = read_csv_any(veh_path)
-    cas = read_csv_any(cas_path)
+    # Arrow releases the GIL while parsing, so the three files load in parallel
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        f_acc = ex.submit(read_csv_any, acc_path)
+        f_veh = ex.submit(read_csv_any, veh_path)
+        f_cas = ex.submit(read_csv_any, cas_path)
+        acc, veh, cas = f_acc.result(), f_veh.result(), f_cas.result()
 
     # ---- Light clean: sentinels -> NA, key dtypes, dedupe, geo ----
     acc = coerce_sentinels_to_na(acc)
@@ -152,77 +272,85 @@ def main():
     cas = coerce_sentinels_to_na(cas)
 
     # Ensure key columns are strings (prevents join dtype mismatches)
-    for df in (acc, veh, cas):
-        for k in [COLLISION_KEY, "vehicle_reference", "casualty_reference"]:
-            if k in df.columns:
-                df[k] = df[k].astype(str)
+    key_cols = (COLLISION_KEY, "vehicle_reference", "casualty_reference")
+    acc, veh, cas = (
+        df.astype({k: "string[pyarrow]" for k in key_cols if k in df.columns}) for df in (acc, veh, cas)
+    )
+    share_key_categories([acc, veh, cas], COLLISION_KEY)
+    share_key_categories([veh, cas], "vehicle_reference")
 
     # Drop exact duplicates on key combos (safe & minimal)
     if set(VEH_KEYS).issubset(veh.columns):
         before = len(veh)
-        veh = veh.drop_duplicates(subset=VEH_KEYS, keep="first")
+        veh = drop_duplicate_keys(veh, VEH_KEYS)
         logging.info(f"Vehicles: dropped {before - len(veh)} duplicate key-rows")
 
     if set(CAS_KEYS).issubset(cas.columns):
         before = len(cas)
-        cas = cas.drop_duplicates(subset=CAS_KEYS, keep="first")
+        cas = drop_duplicate_keys(cas, CAS_KEYS)
         logging.info(f"Casualties: dropped {before - len(cas)} duplicate key-rows")
 
+    # Column fixes first, then a single row filter (the only full copy of acc)
+    # Normalize speed_limit domain (set weird values to NA; don't drop)
+    if "speed_limit" in acc.columns:
+        speed = pd.to_numeric(acc["speed_limit"], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        acc["speed_limit"] = acc["speed_limit"].where(allowed_speed_mask(speed))
+
+    # Narrow small code/count columns before they get copied into every child row
+    acc = acc.astype({c: "int16[pyarrow]" for c in SMALL_INT_COLS if c in acc.columns})
+
     # Gentle UK geo filter (only drop clearly wrong points; keep NA coords)
     if {"latitude", "longitude"}.issubset(acc.columns):
-        keep = within_uk_mask(acc["latitude"], acc["longitude"])
+        keep = within_uk_mask(
+            acc["latitude"].to_numpy(dtype=np.float64, na_value=np.nan),
+            acc["longitude"].to_numpy(dtype=np.float64, na_value=np.nan),
+        )
         dropped = int((~keep).sum())
         if dropped:
             logging.info(f"Collisions: dropping {dropped} rows outside UK bounds {UK_LAT_BOUNDS}/{UK_LON_BOUNDS}")
-        acc = acc.loc[keep].reset_index(drop=True)
-
-    # Normalize speed_limit domain (set weird values to NA; don't drop)
-    if "speed_limit" in acc.columns:
-        s = pd.to_numeric(acc["speed_limit"], errors="coerce")
-        acc.loc[~s.isin(list(ALLOWED_SPEEDS)), "speed_limit"] = pd.NA
+        acc = acc.iloc[keep].reset_index(drop=True)
 
     # ---- Collision context for enriching children ----
     ctx_cols = [c for c in COLLISION_CONTEXT if c in acc.columns]
-    acc_ctx = acc[ctx_cols].copy()
+    acc_ctx = acc[ctx_cols].set_index(COLLISION_KEY)  # new frame; indexed once, reused by both merges
 
     # ---- Save collisions (clean) ----
     out_acc = PROCESSED / "collisions_clean.parquet"
-    acc.to_parquet(out_acc, index=False)
+    write_parquet(pa.Table.from_pandas(acc, preserve_index=False), out_acc)
     logging.info(f"Saved {out_acc} ({len(acc):,} rows)")
 
     # ---- Enrich vehicles with collision context ----
     if COLLISION_KEY in veh.columns:
-        veh_en = veh.merge(acc_ctx, on=COLLISION_KEY, how="left", validate="many_to_one")
+        veh_en = veh.merge(acc_ctx, left_on=COLLISION_KEY, right_index=True, how="left", validate="many_to_one")
     else:
-        veh_en = veh.copy()
+        veh_en = veh
+    assert veh_en[COLLISION_KEY].notna().all()
 
     out_veh = PROCESSED / "vehicles_enriched.parquet"
-    veh_en.to_parquet(out_veh, index=False)
+    write_parquet(pa.Table.from_pandas(veh_en, preserve_index=False), out_veh)
     logging.info(f"Saved {out_veh} ({len(veh_en):,} rows)")
+    del veh_en  # written; don't hold it through the casualty merge
 
     # ---- Enrich casualties with collision context (+optional vehicle attribute) ----
-    cas_en = cas.merge(acc_ctx, on=COLLISION_KEY, how="left", validate="many_to_one")
+    cas_en = cas.merge(acc_ctx, left_on=COLLISION_KEY, right_index=True, how="left", validate="many_to_one")
     if {"vehicle_type"}.issubset(veh.columns):  # handy extra field, if present
-        veh_pick = veh[VEH_KEYS + ["vehicle_type"]].drop_duplicates(VEH_KEYS)
-        cas_en = cas_en.merge(veh_pick, on=VEH_KEYS, how="left", validate="many_to_one")
+        veh_pick = veh.set_index(VEH_KEYS)[["vehicle_type"]]  # veh is already unique on VEH_KEYS
+        cas_en = cas_en.merge(veh_pick, left_on=VEH_KEYS, right_index=True, how="left", validate="many_to_one")
+    assert cas_en[COLLISION_KEY].notna().all()
 
     out_cas = PROCESSED / "casualties_enriched.parquet"
-    cas_en.to_parquet(out_cas, index=False)
+    write_parquet(pa.Table.from_pandas(cas_en, preserve_index=False), out_cas)
     logging.info(f"Saved {out_cas} ({len(cas_en):,} rows)")
+    del cas_en
 
     # ---- Post-merge sanity logs ----
-    assert veh_en[COLLISION_KEY].notna().all()
-    assert cas_en[COLLISION_KEY].notna().all()
-
     if "number_of_vehicles" in acc.columns and "vehicle_reference" in veh.columns:
-        veh_counts = veh.groupby(COLLISION_KEY, dropna=False)["vehicle_reference"].nunique()
-        mismatches = (acc.set_index(COLLISION_KEY)["number_of_vehicles"].sub(veh_counts, fill_value=0) != 0).sum()
-        logging.info(f"Vehicle-count parity mismatches: {int(mismatches)}")
+        mismatches = count_parity_mismatches(acc, veh, "number_of_vehicles", "vehicle_reference")
+        logging.info(f"Vehicle-count parity mismatches: {mismatches}")
 
     if "number_of_casualties" in acc.columns and "casualty_reference" in cas.columns:
-        cas_counts = cas.groupby(COLLISION_KEY, dropna=False)["casualty_reference"].nunique()
-        mismatches = (acc.set_index(COLLISION_KEY)["number_of_casualties"].sub(cas_counts, fill_value=0) != 0).sum()
-        logging.info(f"Casualty-count parity mismatches: {int(mismatches)}")
+        mismatches = count_parity_mismatches(acc, cas, "number_of_casualties", "casualty_reference")
+        logging.info(f"Casualty-count parity mismatches: {mismatches}")
 
     logging.info("Load + merge complete.")
 
@@ -0,0 +1,82 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+import load_merge  # noqa: E402
+
+
+def test_coerce_sentinels_single_nullable_arrow_int_column(tmp_path):
+    p = tmp_path / "c.csv"
+    p.write_text("collision_index,speed_limit\nA,30\nB,\nC,99\n")
+    df = load_merge.coerce_sentinels_to_na(load_merge.read_csv_any(p))
+    assert isinstance(df["speed_limit"].dtype, pd.ArrowDtype)
+    assert df["speed_limit"].tolist()[0] == 30
+    assert df["speed_limit"].isna().tolist() == [False, True, True]
+
+
+def test_coerce_sentinels_when_leading_rows_are_empty(tmp_path):
+    p = tmp_path / "c.csv"
+    rows = ["collision_index,road_type"] + [f"K{i}," for i in range(2000)] + ["K2000,3", "K2001,-1"]
+    p.write_text("\n".join(rows) + "\n")
+    df = load_merge.coerce_sentinels_to_na(load_merge.read_csv_any(p))
+    assert len(df) == 2002
+    assert df["road_type"].iloc[-2] == 3
+    assert pd.isna(df["road_type"].iloc[-1])
+
+
+def test_write_parquet_publishes_categorical_keys_as_plain_strings(tmp_path):
+    keys = pd.Series(["A", "B"], dtype=pd.CategoricalDtype(["A", "B", "ORPHAN"]))
+    df = pd.DataFrame({"collision_index": keys, "collision_year": [2020, 2021]})
+    out = tmp_path / "t.parquet"
+    load_merge.write_parquet(pa.Table.from_pandas(df, preserve_index=False), out)
+    field = pq.read_schema(out).field("collision_index")
+    assert pa.types.is_large_string(field.type) or pa.types.is_string(field.type)
+    assert pd.read_parquet(out)["collision_index"].tolist() == ["A", "B"]
+
+
+def test_parity_counts_distinct_casualty_refs_not_rows():
+    cats = pd.CategoricalDtype(["C1", "C2", "C3"])
+    acc = pd.DataFrame({
+        "collision_index": pd.Series(["C1", "C2"], dtype=cats),
+        "number_of_casualties": [1, 2],
+    })
+    # C1: same casualty_reference under two vehicles -> one casualty; C2: two casualties + an NA ref
+    cas = pd.DataFrame({
+        "collision_index": pd.Series(["C1", "C1", "C2", "C2", "C2"], dtype=cats),
+        "vehicle_reference": ["1", "2", "1", "1", "1"],
+        "casualty_reference": pd.array(["1", "1", "1", "2", None], dtype="string[pyarrow]"),
+    })
+    assert load_merge.count_parity_mismatches(acc, cas, "number_of_casualties", "casualty_reference") == 0
+
+
+def test_parity_counts_every_na_stated_count_as_mismatch():
+    cats = pd.CategoricalDtype(["C1", "C2", "C3"])
+    acc = pd.DataFrame({
+        "collision_index": pd.Series(["C1", "C2", "C3"], dtype=cats),
+        "number_of_vehicles": pd.array([None, None, 1], dtype="Int64"),
+    })
+    veh = pd.DataFrame({  # C1/C2 NA stated (with and without a vehicle) both mismatch; C3 is consistent
+        "collision_index": pd.Series(["C1", "C3"], dtype=cats),
+        "vehicle_reference": ["1", "1"],
+    })
+    assert load_merge.count_parity_mismatches(acc, veh, "number_of_vehicles", "vehicle_reference") == 2
+
+
+def test_share_key_categories_skips_missing_key():
+    veh = pd.DataFrame({"collision_index": ["A"]})
+    cas = pd.DataFrame({"collision_index": ["A"]})
+    load_merge.share_key_categories([veh, cas], "vehicle_reference")
+    assert list(veh.columns) == ["collision_index"]
+    assert list(cas.columns) == ["collision_index"]
+
+
+def test_read_csv_any_keeps_leading_zeros_on_reference_columns(tmp_path):
+    p = tmp_path / "c.csv"
+    p.write_text("collision_index,collision_ref_no\n2020010219808,010219808\n")
+    df = load_merge.read_csv_any(p)
+    assert df["collision_ref_no"].tolist() == ["010219808"]
+    assert df["collision_index"].tolist() == ["2020010219808"]